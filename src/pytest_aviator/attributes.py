@@ -1,10 +1,12 @@
 DEFAULT_MAX_RUNS = 1
 DEFAULT_MIN_PASSES = 1
+# Name of the attribute holding the dict of FlakyTestAttributes on a flaky test item.
+FLAKY_STATE = "_flakybot"
 
 
 class FlakyTestAttributes:
     """
-    Attributes that will be added to flaky tests.
+    Keys of the flaky state dict stored on flaky tests.
     """
     FAILURES = "failures"
     RUNS = "runs"
@@ -12,23 +14,14 @@ class FlakyTestAttributes:
     MAX_RUNS = "max_runs"
     MIN_PASSES = "min_passes"
 
-    def items(self):
-        return (
-            self.FAILURES,
-            self.PASSES,
-            self.RUNS,
-            self.MAX_RUNS,
-            self.MIN_PASSES,
-        )
-
     @staticmethod
     def default_flaky_attributes(max_runs=None, min_passes=None):
         """
-        Returns the default flaky attributes to set on a flaky test.
+        Returns the default flaky state to store on a flaky test.
 
         :param max_runs: The value of the MAX_RUNS attribute to use.
         :param min_passes: The value of the MIN_PASSES attribute to use.
-        :return: Dict of default flaky attributes to set on a flaky test.
+        :return: Dict of default flaky attributes to store on a flaky test.
         """
         if not max_runs:
             max_runs = DEFAULT_MAX_RUNS
@@ -44,4 +37,5 @@ class FlakyTestAttributes:
             FlakyTestAttributes.MIN_PASSES: min_passes,
             FlakyTestAttributes.RUNS: 0,
             FlakyTestAttributes.PASSES: 0,
+            FlakyTestAttributes.FAILURES: [],
         }
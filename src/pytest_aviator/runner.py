@@ -1,7 +1,17 @@
+import contextlib
+import hashlib
+import json
+import logging
 import os
+import tempfile
+import threading
+import time
+import weakref
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-from pytest_aviator.attributes import FlakyTestAttributes, DEFAULT_MIN_PASSES, DEFAULT_MAX_RUNS
+from pytest_aviator.attributes import FlakyTestAttributes, DEFAULT_MIN_PASSES, DEFAULT_MAX_RUNS, FLAKY_STATE
 from _pytest import runner
 from io import StringIO
 
@@ -9,11 +19,38 @@ API_URL = "https://api.aviator.co/api/v1/flaky-tests"
 AVIATOR_MARKER = "aviator"
 BUILDKITE_JOB_PREFIX = "buildkite/"
 CIRCLECI_JOB_PREFIX = "ci/circleci:"
+logger = logging.getLogger("flakybot")
+# Environment variables read when fetching flaky tests.
+ENV_VARS = (
+    "CIRCLE_JOB",
+    "CIRCLE_PROJECT_USERNAME",
+    "CIRCLE_PROJECT_REPONAME",
+    "BUILDKITE_PIPELINE_SLUG",
+    "BUILDKITE_REPO",
+    "AVIATOR_API_URL",
+    "AVIATOR_API_TOKEN",
+    "AVIATOR_NO_CACHE",
+    "FLAKYBOT_CACHE_TTL",
+)
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "flakybot")
+DEFAULT_CACHE_TTL = 300
+# (connect, read) timeouts in seconds for requests to the Aviator API.
+API_TIMEOUT = (3.05, 10)
+
+
+def _build_session():
+    session = requests.Session()
+    retry = Retry(total=2, backoff_factor=0.2, status_forcelist=(500, 502, 503, 504))
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=2, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
 
 
 class FlakybotRunner:
     runner = None
     flaky_tests = {}
+    flaky_lookup = {}
     min_passes = DEFAULT_MIN_PASSES
     max_runs = DEFAULT_MAX_RUNS
     call_infos = {}
@@ -21,10 +58,19 @@ class FlakybotRunner:
     log_xml = None
     xml_key = None
     config = None
+    fetch_thread = None
+    fetch_error = None
+    session = _build_session()
 
     def __init__(self):
         super().__init__()
-        self.get_flaky_tests()
+        self.fetched = threading.Event()
+        self.fetch_lock = threading.Lock()
+        self.patch_lock = threading.Lock()
+        self.patch_count = 0
+        self.default_call_and_report = None
+        # Class names keyed by the parent node, since all tests under a parent share the same class.
+        self.class_name_cache = weakref.WeakKeyDictionary()
 
     def pytest_configure(self, config):
         """
@@ -36,7 +82,15 @@ class FlakybotRunner:
         """
         self.config = config
         self.runner = config.pluginmanager.getplugin("runner")
-        config.addinivalue_line("markers", f"{AVIATOR_MARKER}: marks flaky tests for Flakybot to automatically rerun")
+        # Fetch flaky tests in the background so collection doesn't wait on the Aviator API.
+        if self.fetch_thread is None:
+            self.fetch_thread = threading.Thread(target=self.get_flaky_tests, daemon=True)
+            self.fetch_thread.start()
+        config.addinivalue_line(
+            "markers",
+            f"{AVIATOR_MARKER}(fast_rerun=False): marks flaky tests for Flakybot to automatically rerun. "
+            "With fast_rerun=True, only the test body is rerun and its fixtures are reused."
+        )
         # Get the xml_key from the JUnitXml plugin so we can modify the xml later.
         # https://docs.pytest.org/en/7.1.x/_modules/_pytest/junitxml.html
         junit_plugin = config.pluginmanager.getplugin("junitxml")
@@ -51,92 +105,295 @@ class FlakybotRunner:
 
         :param terminalreporter: Pytest terminal reporter object.
         """
+        # Only report a fetch error if the fetch is already done, so eg. `--collect-only` never waits on the API.
+        fetch_done = self.fetch_thread is None or not self.fetch_thread.is_alive()
+        if fetch_done and not self.config.option.collectonly:
+            self.ensure_fetched()
         self.construct_flakybot_report(terminalreporter)
 
     def get_flaky_tests(self):
         repo_name = None
         job_name = None
+        env = {key: os.environ.get(key, "") for key in ENV_VARS}
 
         # Get job and repo name
-        if os.environ.get("CIRCLE_JOB"):
+        if env["CIRCLE_JOB"]:
             # https://circleci.com/docs/2.0/env-vars/#built-in-environment-variables
-            job_name = CIRCLECI_JOB_PREFIX + os.environ.get("CIRCLE_JOB", "")
+            job_name = CIRCLECI_JOB_PREFIX + env["CIRCLE_JOB"]
             repo_name = "{username}/{repo_name}".format(
-                username=os.environ.get("CIRCLE_PROJECT_USERNAME", ""),
-                repo_name=os.environ.get("CIRCLE_PROJECT_REPONAME", "")
+                username=env["CIRCLE_PROJECT_USERNAME"],
+                repo_name=env["CIRCLE_PROJECT_REPONAME"]
             )
-        if os.environ.get("BUILDKITE_PIPELINE_SLUG"):
+        if env["BUILDKITE_PIPELINE_SLUG"]:
             # Note: BUILDKITE_REPO is in the format "git@github.com:{repo_name}.git"
-            job_name = BUILDKITE_JOB_PREFIX + os.environ.get("BUILDKITE_PIPELINE_SLUG", "")
-            repo_name = os.environ.get("BUILDKITE_REPO").replace("git@github.com:", "").replace(".git", "")
+            job_name = BUILDKITE_JOB_PREFIX + env["BUILDKITE_PIPELINE_SLUG"]
+            repo_name = env["BUILDKITE_REPO"].replace("git@github.com:", "").replace(".git", "")
 
         # Fetch flaky test info
-        url = os.environ.get("AVIATOR_API_URL") or API_URL
-        api_token = os.environ.get("AVIATOR_API_TOKEN", "")
+        url = env["AVIATOR_API_URL"] or API_URL
         headers = {
-            "Authorization": "Bearer " + api_token,
+            "Authorization": "Bearer " + env["AVIATOR_API_TOKEN"],
             "Content-Type": "application/json"
         }
         params = {"repo_name": repo_name, "job_name": job_name}
-        response = requests.get(url, headers=headers, params=params).json()
-        av_flaky_tests = response.get("flaky_tests", [])
 
-        for test in av_flaky_tests:
-            if test.get("test_name", ""):
-                self.flaky_tests[test["test_name"]] = test
+        # Reuse a recent API response from disk so repeat pytest runs skip the network round trip.
+        use_cache = env["AVIATOR_NO_CACHE"] != "1"
+        cache_key = hashlib.sha1(f"{repo_name}|{job_name}|{url}".encode()).hexdigest()
+        cache_path = os.path.join(CACHE_DIR, cache_key + ".json")
+        response = self.read_cache(cache_path, env["FLAKYBOT_CACHE_TTL"]) if use_cache else None
+        from_api = response is None
+        if from_api:
+            try:
+                api_response = self.session.get(url, headers=headers, params=params, timeout=API_TIMEOUT)
+                api_response.raise_for_status()
+                response = api_response.json()
+                if not self.is_valid_response(response):
+                    raise ValueError("unexpected response body")
+            except (requests.RequestException, ValueError) as e:
+                # Still run the tests, just without rerunning flaky ones. This runs in the fetch thread, where
+                # pytest's log capture would swallow a warning, so `ensure_fetched` reports it instead.
+                self.fetch_error = f"could not fetch flaky tests from {url}: {e}"
+                return
+
+        # Build new dicts and assign them in one step so readers never see a partially filled dict.
+        try:
+            named_tests = [
+                (test.get("class_name"), test["test_name"], test)
+                for test in response["flaky_tests"] if test.get("test_name")
+            ]
+            flaky_lookup = {(class_name, test_name): test for class_name, test_name, test in named_tests}
+            flaky_tests = {test_name: test for _, test_name, test in named_tests}
+        except (TypeError, AttributeError, KeyError) as e:
+            self.fetch_error = f"could not read flaky tests from {url}: {e!r}"
+            return
+        if from_api and use_cache:
+            self.write_cache(cache_path, response)
+        self.flaky_lookup = flaky_lookup
+        self.flaky_tests = flaky_tests
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("flaky tests: %s", list(self.flaky_lookup))
+
+    @staticmethod
+    def read_cache(cache_path, ttl=None):
+        """
+        Reads a cached API response if it is younger than the TTL.
+
+        :param cache_path: Path of the cache file.
+        :param ttl: Maximum age of the cache file in seconds, from FLAKYBOT_CACHE_TTL. Defaults to DEFAULT_CACHE_TTL.
+        :return: The cached response dict, or None if missing, expired, unreadable, or malformed.
+        """
+        try:
+            if time.time() - os.path.getmtime(cache_path) > float(ttl or DEFAULT_CACHE_TTL):
+                return None
+            with open(cache_path, "r") as f:
+                response = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return response if FlakybotRunner.is_valid_response(response) else None
+
+    @staticmethod
+    def is_valid_response(response):
+        """
+        Checks that an API response has the shape `get_flaky_tests` expects, so a bad body is never cached.
+
+        :param response: The decoded response body.
+        :return: True if the response is a dict with a "flaky_tests" list, otherwise False.
+        """
+        return isinstance(response, dict) and isinstance(response.get("flaky_tests"), list)
+
+    @staticmethod
+    def write_cache(cache_path, response):
+        """
+        Atomically writes an API response to the cache. Failures are ignored since the cache is best effort.
+
+        :param cache_path: Path of the cache file.
+        :param response: The response dict to store.
+        """
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path), suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w") as f:
+                    json.dump(response, f)
+                os.replace(tmp_path, cache_path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        except (OSError, TypeError, ValueError):
+            pass
+
+    def ensure_fetched(self):
+        """
+        Blocks until the background flaky test fetch started in `pytest_configure` has finished,
+            and adds any fetch error to the FlakyBot report.
+        """
+        if self.fetched.is_set():
+            return
+        # Called from more than one hook, so make sure a fetch error is only reported once.
+        with self.fetch_lock:
+            if self.fetched.is_set():
+                return
+            if self.fetch_thread is None:
+                self.get_flaky_tests()
+            else:
+                self.fetch_thread.join()
+            if self.fetch_error:
+                logger.warning(self.fetch_error)
+                self.stream.write(f"WARNING: {self.fetch_error}\n\n")
+            self.fetched.set()
 
     def pytest_runtest_protocol(self, item, nextitem):
-        class_name = self.get_class_name(item)
-
-        if (
-            self.flaky_tests and
-            self.flaky_tests.get(item.name) and
-            self.flaky_tests[item.name].get("class_name") in class_name
-        ):
-            min_passes = self.min_passes
-            max_runs = self.max_runs
-            if self.flaky_tests[item.name].get("min_passes"):
-                min_passes = self.flaky_tests[item.name]["min_passes"]
-            if self.flaky_tests[item.name].get("max_runs"):
-                max_runs = self.flaky_tests[item.name]["max_runs"]
-            self.mark_flaky(item, max_runs, min_passes)
-
-        self.call_infos[item] = {}
-        default_call_and_report = self.runner.call_and_report
-        should_rerun = True
+        self.ensure_fetched()
+        entry = self.get_flaky_entry(item) if self.flaky_tests else None
+        if not entry:
+            # Not a flaky test, let pytest run its default protocol.
+            return None
+
+        min_passes = entry.get("min_passes") or self.min_passes
+        max_runs = entry.get("max_runs") or self.max_runs
+        self.mark_flaky(item, max_runs, min_passes)
+
+        with self.patched_runner():
+            self.call_infos[item] = {}
+            should_rerun = True
+            try:
+                if self.is_fast_rerun(item):
+                    should_rerun = self.run_fast_rerun_protocol(item, nextitem)
+                while should_rerun:
+                    self.runner.pytest_runtest_protocol(item, nextitem)
+                    for when in ["setup", "call"]:
+                        call_info = self.call_infos.get(item, {}).get(when, None)
+                        exc_info = getattr(call_info, "excinfo", None)
+                        if exc_info:
+                            break
+
+                    if not call_info:
+                        return False
+                    should_rerun = self.record_run(item, exc_info)
+            finally:
+                del self.call_infos[item]
+        return True
+
+    @contextlib.contextmanager
+    def patched_runner(self):
+        """
+        Replaces `runner.call_and_report` with `self.call_and_report` while any test is running.
+            The patch is shared and reference counted, so tests running concurrently in other threads
+            don't restore the original function while it is still needed. Those tests are passed through
+            to the original function by `call_and_report`.
+        """
+        with self.patch_lock:
+            if self.patch_count == 0:
+                self.default_call_and_report = self.runner.call_and_report
+                self.runner.call_and_report = self.call_and_report
+            self.patch_count += 1
         try:
-            self.runner.call_and_report = self.call_and_report
-            while should_rerun:
-                self.runner.pytest_runtest_protocol(item, nextitem)
-                for when in ["setup", "call"]:
-                    call_info = self.call_infos.get(item, {}).get(when, None)
-                    exc_info = getattr(call_info, "excinfo", None)
-                    if exc_info:
-                        break
-
-                if not call_info:
-                    return False
-                passed = not exc_info
-
-                # This is the only place we modify FlakyTestAttributes on the test object (RUNS, PASSES, FAILURES).
-                # `pytest_runtest_protocol` corresponds with each test run.
-                if passed:
-                    should_rerun = self.add_success(item)
-                else:
-                    should_rerun = self.add_failure(item, exc_info)
-                    if not should_rerun:
-                        item.excinfo = exc_info
+            yield
         finally:
-            self.runner.call_and_report = default_call_and_report
-            del self.call_infos[item]
-        return True
+            with self.patch_lock:
+                self.patch_count -= 1
+                if self.patch_count == 0:
+                    self.runner.call_and_report = self.default_call_and_report
+
+    def record_run(self, item, exc_info):
+        """
+        Records the result of one run of a test.
+
+        :param item: The test `Item` object.
+        :param exc_info: Error information if the run failed, otherwise None.
+        :return: True if the test should be rerun, otherwise False.
+        """
+        # This is the only place we modify FlakyTestAttributes on the test object (RUNS, PASSES, FAILURES).
+        # It is called exactly once for each test run.
+        if not exc_info:
+            return self.add_success(item)
+        should_rerun = self.add_failure(item, exc_info)
+        if not should_rerun:
+            item.excinfo = exc_info
+        return should_rerun
 
-    def call_and_report(self, item, when, log=True, **kwds):
+    def is_fast_rerun(self, item):
+        """
+        Checks if a flaky test opted in to fast reruns with `@pytest.mark.aviator(fast_rerun=True)`.
+
+        :param item: The test `Item` object.
+        :return: True if only the "call" phase should be rerun, otherwise False.
+        """
+        if self.config.getoption("setuponly", False):
+            return False
+        marker = item.get_closest_marker(AVIATOR_MARKER)
+        return bool(marker and marker.kwargs.get("fast_rerun"))
+
+    def run_fast_rerun_protocol(self, item, nextitem):
+        """
+        Runs a test like `runner.pytest_runtest_protocol`, but repeats only the "call" phase between
+            setup and teardown. Fixtures are set up once and reused by every rerun, so this is only safe
+            for tests whose fixtures are still usable after a failed run.
+
+        :param item: The test `Item` object.
+        :param nextitem: The next test `Item` object, used to decide what to tear down.
+        :return: True if setup failed and the test should be rerun with the full protocol, otherwise False.
+        """
+        ihook = item.ihook
+        ihook.pytest_runtest_logstart(nodeid=item.nodeid, location=item.location)
+        has_request = hasattr(item, "_request")
+        if has_request and not item._request:
+            item._initrequest()
+
+        # Setup is not repeated, so its report is always logged if it passes.
+        self.call_and_report(item, "setup", log_passed_setup=True)
+        exc_info = self.call_infos[item]["setup"].excinfo
+        if exc_info:
+            should_rerun = self.record_run(item, exc_info)
+        else:
+            if item.config.getoption("setupshow", False):
+                runner.show_test_item(item)
+            should_rerun = True
+            while should_rerun:
+                self.call_and_report(item, "call")
+                should_rerun = self.record_run(item, self.call_infos[item]["call"].excinfo)
+
+        # Tear everything down if the session is stopping, eg. with `-x` or `--maxfail`.
+        if item.session.shouldfail or item.session.shouldstop:
+            nextitem = None
+        self.call_and_report(item, "teardown", nextitem=nextitem)
+        if has_request:
+            item._request = False
+            item.funcargs = None
+        ihook.pytest_runtest_logfinish(nodeid=item.nodeid, location=item.location)
+        return should_rerun
+
+    def get_flaky_entry(self, item):
+        """
+        Gets the Aviator flaky test info for a test.
+        The class name reported by Aviator may omit leading packages, so every dotted suffix of the
+        test's class name is tried, eg. "src.test.TestSample", "test.TestSample", then "TestSample".
+
+        :param item: The test `Item` object.
+        :return: The flaky test dict, or None if the test is not flaky.
+        """
+        if item.name not in self.flaky_tests:
+            return None
+        parts = self.get_class_name(item).split(".")
+        for i in range(len(parts)):
+            entry = self.flaky_lookup.get((".".join(parts[i:]), item.name))
+            if entry:
+                return entry
+        return None
+
+    def call_and_report(self, item, when, log=True, log_passed_setup=False, **kwds):
         """
         Monkey patch this runner method - https://docs.pytest.org/en/7.1.x/_modules/_pytest/runner.html.
             We do this to access `pytest_runtest_logreport`. This allows us to avoid reporting each test rerun
             and only report the final status of a test once all reruns are complete.
+            Tests that aren't being rerun, eg. ones running in another thread while the patch is installed,
+            are handed to the original `call_and_report`.
+            `log_passed_setup` logs a passed setup even if the test will be rerun, for fast reruns where setup
+            runs only once.
         """
+        if item not in self.call_infos:
+            return self.default_call_and_report(item, when, log, **kwds)
         call = runner.call_runtest_hook(item, when, **kwds)
         self.call_infos[item][when] = call
         hook = item.ihook
@@ -147,7 +404,7 @@ class FlakybotRunner:
         if not self.log_xml:
             self.log_xml = self.config.stash.get(self.xml_key, None)
         if not self.log_xml:
-            print("ERROR: use the --junitxml flag in your pytest run.")
+            logger.error("use the --junitxml flag in your pytest run.")
             return
         reporter = self.log_xml._opentestcase(report)
 
@@ -157,7 +414,7 @@ class FlakybotRunner:
         #   "teardown" phase.
         if report.when in ("call", "setup"):
             if report.outcome == "passed":
-                if self.should_rerun(item, passed=True):
+                if self.should_rerun(item, passed=True) and not (report.when == "setup" and log_passed_setup):
                     log = False
                     if report.when == "call":
                         reporter.append_pass(report)
@@ -186,10 +443,23 @@ class FlakybotRunner:
             eg. "src.test.TestSample" for tests within a class
                 or "src.test" for tests not in a class
         """
-        test_instance = self.get_test_instance(test)
-        class_name = test_instance.__name__
-        if getattr(test_instance, "__module__", None):
-            class_name = test_instance.__module__ + "." + test_instance.__name__
+        parent = getattr(test, "parent", None)
+        try:
+            return self.class_name_cache[parent]
+        except (KeyError, TypeError):
+            pass
+
+        cls = getattr(test, "cls", None)
+        if cls is not None:
+            class_name = cls.__module__ + "." + cls.__name__
+        else:
+            module = getattr(test, "module", None) or getattr(parent, "obj", None)
+            class_name = getattr(module, "__name__", "")
+        try:
+            self.class_name_cache[parent] = class_name
+        except TypeError:
+            # The parent is missing or can't be weakly referenced.
+            pass
         return class_name
 
     @staticmethod
@@ -206,39 +476,24 @@ class FlakybotRunner:
         return callable_name
 
     @staticmethod
-    def get_test_instance(item):
-        test_instance = getattr(item, "instance", None)
-        if test_instance is None:
-            if hasattr(item, "parent") and hasattr(item.parent, "obj"):
-                test_instance = item.parent.obj
-        return test_instance
-
-    @staticmethod
-    def get_flaky_attribute(test_item, attr):
-        return getattr(test_item, attr, None)
-
-    @staticmethod
-    def set_flaky_attribute(test_item, attr, value):
+    def get_flaky_state(test_item):
         """
-        Sets an attribute on a flaky test.
+        Gets the dict of FlakyTestAttributes stored on a flaky test.
 
-        :param test_item: The test `Item` object to set the attribute for.
-        :param attr: The name of the attribute.
-        :param value: The value to set the attribute to.
+        :param test_item: The test `Item` object.
+        :return: The flaky state dict, or None if the test is not flaky.
         """
-        test_item.__dict__[attr] = value
+        return test_item.__dict__.get(FLAKY_STATE)
 
     def mark_flaky(self, test, max_runs=None, min_passes=None):
         """
-        Mark a test as flaky by setting flaky attributes.
+        Mark a test as flaky by storing its flaky attributes on the test.
 
         :param test: The test `Item` object.
         :param max_runs: The value of the FlakyTestAttributes.MAX_RUNS attribute to use.
         :param min_passes: The value of the FlakyTestAttributes.MIN_PASSES attribute to use.
         """
-        attr_dict = FlakyTestAttributes.default_flaky_attributes(max_runs, min_passes)
-        for attr, value in attr_dict.items():
-            self.set_flaky_attribute(test, attr, value)
+        test.__dict__[FLAKY_STATE] = FlakyTestAttributes.default_flaky_attributes(max_runs, min_passes)
 
     def should_rerun(self, test, passed=False):
         """
@@ -249,15 +504,19 @@ class FlakybotRunner:
         :param passed: Whether the test passed.
         :return: True if the test should be rerun, otherwise False.
         """
-        if not self.has_flaky_overrides(test):
+        state = self.get_flaky_state(test)
+        if state is None:
             return False
-        runs = self.get_flaky_attribute(test, FlakyTestAttributes.RUNS) + 1
-        max_runs = self.get_flaky_attribute(test, FlakyTestAttributes.MAX_RUNS)
-        passes = self.get_flaky_attribute(test, FlakyTestAttributes.PASSES)
-        min_passes = self.get_flaky_attribute(test, FlakyTestAttributes.MIN_PASSES)
+        runs = state[FlakyTestAttributes.RUNS] + 1
+        passes = state[FlakyTestAttributes.PASSES]
         if passed:
             passes += 1
-        return self.should_rerun_test(runs=runs, max_runs=max_runs, passes=passes, min_passes=min_passes)
+        return self.should_rerun_test(
+            runs=runs,
+            max_runs=state[FlakyTestAttributes.MAX_RUNS],
+            passes=passes,
+            min_passes=state[FlakyTestAttributes.MIN_PASSES],
+        )
 
     def add_failure(self, test, exc_info):
         """
@@ -268,17 +527,17 @@ class FlakybotRunner:
         :return: True if the test has not reached MAX_RUNS and should be rerun, otherwise False.
         """
         if exc_info:
-            error = (exc_info.type, exc_info.value, exc_info.traceback)
+            # Store only the rendered error so the frames and locals of each failed run can be freed.
+            error = (exc_info.type, str(exc_info.value), str(self.get_pruned_traceback(test, exc_info)))
         else:
             error = (None, None, None)
 
-        if self.has_flaky_overrides(test):
+        state = self.get_flaky_state(test)
+        if state is not None:
             # Must do the `should_rerun` check before incrementing RUNS, the method itself will add 1 run.
             should_rerun = self.should_rerun(test, passed=False)
-            all_errors = self.get_flaky_attribute(test, FlakyTestAttributes.FAILURES) or []
-            all_errors.append(error)
-            self.set_flaky_attribute(test, FlakyTestAttributes.FAILURES, all_errors)
-            self.increment(test, FlakyTestAttributes.RUNS)
+            state[FlakyTestAttributes.FAILURES].append(error)
+            state[FlakyTestAttributes.RUNS] += 1
 
             if should_rerun:
                 self.log_rerun_failure(test, error)
@@ -286,10 +545,27 @@ class FlakybotRunner:
             self.stream.writelines([
                 str(self.get_test_name(test)),
                 ": FAILED\n\t",
-                f"It passed {self.get_flaky_attribute(test, FlakyTestAttributes.PASSES)} out of the required {self.get_flaky_attribute(test, FlakyTestAttributes.MIN_PASSES)} times.\n"
+                f"It passed {state[FlakyTestAttributes.PASSES]} out of the required "
+                f"{state[FlakyTestAttributes.MIN_PASSES]} times.\n"
             ])
         return False
 
+    @staticmethod
+    def get_pruned_traceback(test, exc_info):
+        """
+        Gets the traceback of a test failure without pytest and pluggy internal frames.
+
+        :param test: The test `Item` object.
+        :param exc_info: Error information.
+        :return: The pruned traceback.
+        """
+        traceback_filter = getattr(test, "_traceback_filter", None)
+        if traceback_filter is not None:
+            # pytest >= 7.4
+            return traceback_filter(exc_info)
+        # Older pytest versions prune the traceback in place when reporting the failure.
+        return exc_info.traceback
+
     def add_success(self, test):
         """
         Add a test success. Record the success in the form of FlakyTestAttributes (RUNS, PASSES).
@@ -297,14 +573,15 @@ class FlakybotRunner:
         :param test: The test that passed.
         :return: True if the test has not reached MIN_PASSES and should be rerun, otherwise False.
         """
-        if not self.has_flaky_overrides(test):
+        state = self.get_flaky_state(test)
+        if state is None:
             return False
         # Must do the `should_rerun` check before incrementing RUNS and PASSES, the method itself will add 1 run/pass.
         should_rerun = self.should_rerun(test, passed=True)
-        self.increment(test, FlakyTestAttributes.RUNS)
-        self.increment(test, FlakyTestAttributes.PASSES)
-        passes = self.get_flaky_attribute(test, FlakyTestAttributes.PASSES)
-        min_passes = self.get_flaky_attribute(test, FlakyTestAttributes.MIN_PASSES)
+        state[FlakyTestAttributes.RUNS] += 1
+        state[FlakyTestAttributes.PASSES] += 1
+        passes = state[FlakyTestAttributes.PASSES]
+        min_passes = state[FlakyTestAttributes.MIN_PASSES]
 
         self.stream.writelines([
             str(self.get_test_name(test)),
@@ -314,13 +591,10 @@ class FlakybotRunner:
             self.stream.write(f"Running test again until it passes {min_passes} times.\n\n")
         return should_rerun
 
-    def increment(self, test, attribute):
-        self.set_flaky_attribute(test, attribute, getattr(test, attribute, 0) + 1)
-
     def log_rerun_failure(self, test, error):
-        max_runs = self.get_flaky_attribute(test, FlakyTestAttributes.MAX_RUNS)
-        current_runs = self.get_flaky_attribute(test, FlakyTestAttributes.RUNS)
-        runs_left = max_runs - current_runs
+        state = self.get_flaky_state(test)
+        max_runs = state[FlakyTestAttributes.MAX_RUNS]
+        runs_left = max_runs - state[FlakyTestAttributes.RUNS]
 
         self.stream.writelines([
             str(self.get_test_name(test)),
@@ -354,10 +628,16 @@ class FlakybotRunner:
 
     @staticmethod
     def has_flaky_overrides(test):
-        return FlakyTestAttributes.MIN_PASSES in test.__dict__
+        return FLAKY_STATE in test.__dict__
+
 
+# Pytest hooks implemented by FlakybotRunner, exposed at module level for the pytest11 entry point.
+HOOKS = (
+    "pytest_configure",
+    "pytest_runtest_protocol",
+    "pytest_terminal_summary",
+)
 
 PLUGIN = FlakybotRunner()
-for _pytest_hook in dir(PLUGIN):
-    if _pytest_hook.startswith("pytest_"):
-        globals()[_pytest_hook] = getattr(PLUGIN, _pytest_hook)
+for _pytest_hook in HOOKS:
+    globals()[_pytest_hook] = getattr(PLUGIN, _pytest_hook)
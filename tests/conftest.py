@@ -0,0 +1,87 @@
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+pytest_plugins = ["pytester"]
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+
+
+def _plugin_installed():
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        return False
+    eps = entry_points()
+    group = eps.select(group="pytest11") if hasattr(eps, "select") else eps.get("pytest11", [])
+    return any(ep.name == "pytest-aviator" for ep in group)
+
+
+class FakeAviatorAPI:
+    """
+    Serves a fixed flaky test response in place of the Aviator API.
+    """
+
+    def __init__(self):
+        self.status = 200
+        # Statuses to return, in order, before falling back to `status`. Their responses have no flaky tests.
+        self.queued_statuses = []
+        self.body = {"flaky_tests": []}
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if api.queued_statuses:
+                    status, body = api.queued_statuses.pop(0), {"flaky_tests": []}
+                else:
+                    status, body = api.status, api.body
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:{}/api/v1/flaky-tests".format(self.server.server_port)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def set_flaky_tests(self, *flaky_tests):
+        self.body = {"flaky_tests": list(flaky_tests)}
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def aviator_api(monkeypatch, tmp_path):
+    api = FakeAviatorAPI()
+    monkeypatch.setenv("AVIATOR_API_URL", api.url)
+    monkeypatch.setenv("AVIATOR_NO_CACHE", "1")
+    monkeypatch.setenv("HOME", str(tmp_path / "home"))
+    for key in ("CIRCLE_JOB", "BUILDKITE_PIPELINE_SLUG"):
+        monkeypatch.delenv(key, raising=False)
+    pythonpath = os.environ.get("PYTHONPATH")
+    monkeypatch.setenv("PYTHONPATH", SRC_DIR + os.pathsep + pythonpath if pythonpath else SRC_DIR)
+    yield api
+    api.close()
+
+
+@pytest.fixture
+def run_flakybot(pytester, aviator_api):
+    """
+    Runs pytest with the plugin in a subprocess, so every run gets a fresh plugin instance.
+    """
+    def run(*args):
+        plugin_args = [] if _plugin_installed() else ["-p", "pytest_aviator.runner"]
+        junitxml = "--junitxml=" + str(pytester.path / "output.xml")
+        return pytester.runpytest_subprocess(*plugin_args, "-p", "no:cacheprovider", junitxml, *args)
+    return run
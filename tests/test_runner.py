@@ -0,0 +1,295 @@
+import os
+import socket
+import time
+from types import SimpleNamespace
+
+from pytest_aviator.runner import API_TIMEOUT, FlakybotRunner
+
+FLAKY_MODULE = """
+import os
+
+COUNT_FILE = os.path.join(os.path.dirname(__file__), "count.txt")
+
+
+def test_flaky():
+    runs = int(open(COUNT_FILE).read()) if os.path.exists(COUNT_FILE) else 0
+    open(COUNT_FILE, "w").write(str(runs + 1))
+    assert runs > 0
+"""
+
+
+def test_flaky_test_passes_after_failing_once(pytester, aviator_api, run_flakybot):
+    pytester.makepyfile(test_sample=FLAKY_MODULE)
+    aviator_api.set_flaky_tests({"test_name": "test_flaky", "class_name": "test_sample", "max_runs": 3})
+
+    result = run_flakybot()
+
+    result.assert_outcomes(passed=1)
+    result.stdout.fnmatch_lines([
+        "*FAILED: (2 runs remaining out of 3).",
+        "*<class 'AssertionError'>: assert 0 > 0",
+        "*[[]<TracebackEntry *test_sample.py:*>]",
+        "test_flaky passed 1 out of the required 1 times.",
+    ])
+    # Only the test's own frame is rendered, not pytest or pluggy internals.
+    assert result.stdout.str().count("TracebackEntry") == 1
+    result.stdout.no_fnmatch_line("*INTERNALERROR*")
+
+
+def test_flaky_test_fails_when_out_of_runs(pytester, aviator_api, run_flakybot):
+    pytester.makepyfile(test_sample=FLAKY_MODULE)
+    aviator_api.set_flaky_tests({"test_name": "test_flaky", "class_name": "test_sample", "max_runs": 1})
+
+    result = run_flakybot()
+
+    result.assert_outcomes(failed=1)
+    result.stdout.fnmatch_lines(["test_flaky: FAILED", "*It passed 0 out of the required 1 times."])
+
+
+def test_test_not_reported_as_flaky_runs_once(pytester, aviator_api, run_flakybot):
+    pytester.makepyfile(test_sample=FLAKY_MODULE)
+    aviator_api.set_flaky_tests({"test_name": "test_flaky", "class_name": "other_module", "max_runs": 3})
+
+    result = run_flakybot()
+
+    result.assert_outcomes(failed=1)
+
+
+CLASS_MODULE = """
+import os
+
+COUNT_FILE = os.path.join(os.path.dirname(__file__), "count.txt")
+
+
+class TestFooBar:
+    def test_flaky(self):
+        runs = int(open(COUNT_FILE).read()) if os.path.exists(COUNT_FILE) else 0
+        open(COUNT_FILE, "w").write(str(runs + 1))
+        assert runs > 0
+"""
+
+
+def test_flaky_test_in_class_matches_full_class_name(pytester, aviator_api, run_flakybot):
+    pytester.makepyfile(test_sample=CLASS_MODULE)
+    aviator_api.set_flaky_tests({"test_name": "test_flaky", "class_name": "test_sample.TestFooBar", "max_runs": 3})
+
+    run_flakybot().assert_outcomes(passed=1)
+
+
+def test_flaky_test_in_class_matches_class_name_suffix(pytester, aviator_api, run_flakybot):
+    pytester.makepyfile(test_sample=CLASS_MODULE)
+    aviator_api.set_flaky_tests({"test_name": "test_flaky", "class_name": "TestFooBar", "max_runs": 3})
+
+    run_flakybot().assert_outcomes(passed=1)
+
+
+def test_flaky_test_in_class_does_not_match_partial_class_name(pytester, aviator_api, run_flakybot):
+    pytester.makepyfile(test_sample=CLASS_MODULE)
+    aviator_api.set_flaky_tests({"test_name": "test_flaky", "class_name": "Bar", "max_runs": 3})
+
+    result = run_flakybot()
+
+    result.assert_outcomes(failed=1)
+    result.stdout.no_fnmatch_line("*INTERNALERROR*")
+
+
+FAST_RERUN_MODULE = """
+import os
+import pytest
+
+SETUPS = []
+CALLS = []
+
+
+@pytest.fixture
+def resource():
+    SETUPS.append(1)
+    if os.environ.get("FAIL_FIRST_SETUP") and len(SETUPS) == 1:
+        raise RuntimeError("setup failed")
+    yield
+
+
+@pytest.mark.aviator(fast_rerun=True)
+def test_flaky(resource):
+    CALLS.append(1)
+    assert len(CALLS) > 2
+
+
+def test_counts():
+    print("setups=%d calls=%d" % (len(SETUPS), len(CALLS)))
+"""
+
+
+def test_fast_rerun_reuses_fixtures(pytester, aviator_api, run_flakybot):
+    pytester.makepyfile(test_sample=FAST_RERUN_MODULE)
+    aviator_api.set_flaky_tests({"test_name": "test_flaky", "class_name": "test_sample", "max_runs": 5})
+
+    result = run_flakybot("-s")
+
+    result.assert_outcomes(passed=2)
+    result.stdout.fnmatch_lines(["*setups=1 calls=3*"])
+
+
+def test_fast_rerun_falls_back_to_full_reruns_after_setup_failure(pytester, aviator_api, run_flakybot, monkeypatch):
+    monkeypatch.setenv("FAIL_FIRST_SETUP", "1")
+    pytester.makepyfile(test_sample=FAST_RERUN_MODULE)
+    aviator_api.set_flaky_tests({"test_name": "test_flaky", "class_name": "test_sample", "max_runs": 5})
+
+    result = run_flakybot("-s")
+
+    result.assert_outcomes(passed=2)
+    # One failed setup, then a full run for each of the three calls.
+    result.stdout.fnmatch_lines(["*setups=4 calls=3*"])
+
+
+def test_fast_rerun_with_setup_show(pytester, aviator_api, run_flakybot):
+    pytester.makepyfile(test_sample=FAST_RERUN_MODULE)
+    aviator_api.set_flaky_tests({"test_name": "test_flaky", "class_name": "test_sample", "max_runs": 5})
+
+    result = run_flakybot("--setup-show")
+
+    result.assert_outcomes(passed=2)
+    result.stdout.fnmatch_lines(["*SETUP    F resource*", "*test_sample.py::test_flaky (fixtures used: resource)*"])
+
+
+def test_fast_rerun_logs_setup_report(pytester, aviator_api, run_flakybot):
+    pytester.makeconftest("""
+        import os
+
+        def pytest_runtest_logreport(report):
+            if report.nodeid.endswith("test_flaky"):
+                with open(os.path.join(os.path.dirname(__file__), "reports.txt"), "a") as f:
+                    f.write(report.when + "\\n")
+    """)
+    pytester.makepyfile(test_sample=FAST_RERUN_MODULE)
+    aviator_api.set_flaky_tests(
+        {"test_name": "test_flaky", "class_name": "test_sample", "min_passes": 2, "max_runs": 5}
+    )
+
+    result = run_flakybot("-s")
+
+    result.assert_outcomes(passed=2)
+    result.stdout.fnmatch_lines(["*setups=1 calls=4*"])
+    assert (pytester.path / "reports.txt").read_text().split() == ["setup", "call", "teardown"]
+
+
+def test_successful_response_is_cached(pytester, aviator_api, run_flakybot, monkeypatch):
+    monkeypatch.delenv("AVIATOR_NO_CACHE")
+    pytester.makepyfile(test_sample=FLAKY_MODULE)
+    aviator_api.set_flaky_tests({"test_name": "test_flaky", "class_name": "test_sample", "max_runs": 3})
+    run_flakybot().assert_outcomes(passed=1)
+
+    # The second run uses the cached response even though the API now reports no flaky tests.
+    os.remove(pytester.path / "count.txt")
+    aviator_api.set_flaky_tests()
+    run_flakybot().assert_outcomes(passed=1)
+
+
+def test_expired_cache_is_not_used(pytester, aviator_api, run_flakybot, monkeypatch):
+    monkeypatch.delenv("AVIATOR_NO_CACHE")
+    pytester.makepyfile(test_sample=FLAKY_MODULE)
+    aviator_api.set_flaky_tests({"test_name": "test_flaky", "class_name": "test_sample", "max_runs": 3})
+    run_flakybot().assert_outcomes(passed=1)
+
+    os.remove(pytester.path / "count.txt")
+    aviator_api.set_flaky_tests()
+    monkeypatch.setenv("FLAKYBOT_CACHE_TTL", "0")
+    run_flakybot().assert_outcomes(failed=1)
+
+
+def test_error_response_is_not_cached(pytester, aviator_api, run_flakybot, monkeypatch):
+    monkeypatch.delenv("AVIATOR_NO_CACHE")
+    pytester.makepyfile(test_sample=FLAKY_MODULE)
+    aviator_api.status = 401
+    aviator_api.body = {"detail": "Invalid token"}
+
+    result = run_flakybot()
+
+    result.assert_outcomes(failed=1)
+    result.stdout.fnmatch_lines(["WARNING: could not fetch flaky tests from *: 401 Client Error*"])
+    assert not os.path.exists(os.path.join(os.environ["HOME"], ".cache", "flakybot"))
+
+
+def test_malformed_response_is_not_cached(pytester, aviator_api, run_flakybot, monkeypatch):
+    monkeypatch.delenv("AVIATOR_NO_CACHE")
+    pytester.makepyfile(test_sample=FLAKY_MODULE)
+    aviator_api.body = {"flaky_tests": None}
+
+    result = run_flakybot()
+
+    result.assert_outcomes(failed=1)
+    result.stdout.fnmatch_lines(["WARNING: could not fetch flaky tests from *: unexpected response body"])
+    result.stderr.no_fnmatch_line("*Exception in thread*")
+    assert not os.path.exists(os.path.join(os.environ["HOME"], ".cache", "flakybot"))
+
+
+def test_malformed_flaky_test_entries_are_reported(pytester, aviator_api, run_flakybot, monkeypatch):
+    monkeypatch.delenv("AVIATOR_NO_CACHE")
+    pytester.makepyfile(test_sample=FLAKY_MODULE)
+    aviator_api.body = {"flaky_tests": ["test_flaky"]}
+
+    result = run_flakybot()
+
+    result.assert_outcomes(failed=1)
+    result.stdout.fnmatch_lines(["WARNING: could not read flaky tests from *: AttributeError(*"])
+    result.stderr.no_fnmatch_line("*Exception in thread*")
+    assert not os.path.exists(os.path.join(os.environ["HOME"], ".cache", "flakybot"))
+
+
+def test_server_error_is_retried(pytester, aviator_api, run_flakybot):
+    pytester.makepyfile(test_sample=FLAKY_MODULE)
+    aviator_api.queued_statuses = [503]
+    aviator_api.set_flaky_tests({"test_name": "test_flaky", "class_name": "test_sample", "max_runs": 3})
+
+    result = run_flakybot()
+
+    result.assert_outcomes(passed=1)
+    result.stdout.fnmatch_lines(["*FAILED: (2 runs remaining out of 3)."])
+    assert not aviator_api.queued_statuses
+
+
+def test_collect_only_does_not_wait_on_the_api(pytester, aviator_api, run_flakybot, monkeypatch):
+    pytester.makepyfile(test_sample=FLAKY_MODULE)
+    # Accepts connections but never replies, so the fetch only ends at the read timeout.
+    with socket.socket() as server:
+        server.bind(("127.0.0.1", 0))
+        server.listen()
+        monkeypatch.setenv("AVIATOR_API_URL", "http://127.0.0.1:{}/api/v1/flaky-tests".format(server.getsockname()[1]))
+
+        start = time.monotonic()
+        result = run_flakybot("--collect-only", "-q")
+        elapsed = time.monotonic() - start
+
+    result.stdout.fnmatch_lines(["*1 test collected*"])
+    assert elapsed < API_TIMEOUT[1] / 2
+
+
+def test_call_and_report_passes_through_tests_without_call_infos():
+    plugin = FlakybotRunner()
+    calls = []
+
+    def default_call_and_report(item, when, log=True, **kwds):
+        calls.append((item, when, log, kwds))
+        return "report"
+
+    plugin.default_call_and_report = default_call_and_report
+
+    assert plugin.call_and_report("item", "teardown", nextitem=None) == "report"
+    assert calls == [("item", "teardown", True, {"nextitem": None})]
+
+
+def test_patched_runner_restores_call_and_report_after_outermost_exit():
+    def original_call_and_report(item, when, log=True, **kwds):
+        pass
+
+    plugin = FlakybotRunner()
+    plugin.runner = SimpleNamespace(call_and_report=original_call_and_report)
+
+    with plugin.patched_runner():
+        assert plugin.runner.call_and_report == plugin.call_and_report
+        with plugin.patched_runner():
+            assert plugin.runner.call_and_report == plugin.call_and_report
+        # Still patched while the outer holder is active.
+        assert plugin.runner.call_and_report == plugin.call_and_report
+    assert plugin.runner.call_and_report is original_call_and_report
+    assert plugin.patch_count == 0